@@ -1,7 +1,16 @@
-import io
+import os
+import queue
+import struct
+import threading
+import time
 import datetime as dt
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import streamlit as st
 from sqlalchemy import create_engine, text
 
@@ -14,11 +23,14 @@ def get_engine():
     return create_engine(
         st.secrets["DATABASE_URL"],
         pool_pre_ping=True,
+        pool_recycle=3600,
         future=True,
     )
 
 
 engine = get_engine()
+# для SELECT дашборда: тот же пул, но без BEGIN/COMMIT вокруг каждого запроса
+read_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
 
 
 # ===================== Helpers =====================
@@ -45,6 +57,12 @@ def check_password():
 if not check_password():
     st.stop()
 
+def debug_write(*args):
+    """Отладочный лог загрузки — только при включённом «Debug-лог» в сайдбаре."""
+    if st.session_state.get("debug"):
+        st.write(*args)
+
+
 def pick_col(df: pd.DataFrame, candidates: list[str]) -> str:
     # 1) exact (strip)
     stripped_map = {c.strip(): c for c in df.columns}
@@ -66,26 +84,247 @@ def pick_col(df: pd.DataFrame, candidates: list[str]) -> str:
 
 
 def read_csv_ru(f):
-    return pd.read_csv(f, sep=";", encoding="utf-8-sig", engine="python")
+    """
+    Весь CSV через тот же pyarrow-ридер, что и click.csv: все колонки строками,
+    без инференса (subid "00123" не превращается в int 123).
+    """
+    batches = list(iter_csv_ru_batches(f, block_size=16 << 20))
+    if not batches:
+        f.seek(0)
+        return read_csv_ru_header(f)
+    return pd.concat(batches, ignore_index=True)
+
+
+def read_csv_ru_header(f) -> pd.DataFrame:
+    """Только заголовок CSV (пустой DataFrame), файл перематывается в начало."""
+    header = pd.read_csv(f, sep=";", encoding="utf-8-sig", nrows=0)
+    f.seek(0)
+    return header
+
+
+def iter_csv_ru_batches(f, block_size: int, columns=None):
+    """
+    Потоковое чтение большого CSV через pyarrow.csv: многопоточный парсер,
+    на выходе pandas-чанки со строками в Arrow (без python str на каждую ячейку).
+    Все колонки читаются как string — без инференса типов по первому блоку.
+    columns: если задано — материализуются только эти колонки.
+    """
+    names = list(columns) if columns is not None else read_csv_ru_header(f).columns
+
+    reader = pacsv.open_csv(
+        f,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        parse_options=pacsv.ParseOptions(delimiter=";"),
+        convert_options=pacsv.ConvertOptions(
+            column_types={c: pa.string() for c in names},
+            include_columns=names if columns is not None else None,
+            strings_can_be_null=True,
+        ),
+    )
+    for batch in reader:
+        yield batch.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+# форматы времени в выгрузках; с явным format= pandas парсит по быстрому пути
+DATETIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%d.%m.%Y %H:%M:%S", "%Y-%m-%d %H:%M", "%d.%m.%Y %H:%M"]
+DATETIME_FORMAT_MIN_SHARE = 0.9  # доля выборки, которая должна разобраться форматом
+
+
+def detect_datetime_format(s: pd.Series, sample: int = 100):
+    """Формат времени по первым непустым значениям; None — пусть pandas определит сам."""
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return None
+    probe = s.dropna().head(sample).astype(str)
+    if probe.empty:
+        return None
+    # одно битое значение в выборке не должно отключать формат для всего файла
+    for fmt in DATETIME_FORMATS:
+        if pd.to_datetime(probe, format=fmt, errors="coerce").notna().mean() >= DATETIME_FORMAT_MIN_SHARE:
+            return fmt
+    return None
+
+
+def parse_datetime(s: pd.Series, fmt=None) -> pd.Series:
+    return pd.to_datetime(s, format=fmt, errors="coerce", cache=True)
+
+
+def prefetch(it, depth: int = 2):
+    """
+    Итерирует it в фоновом потоке на depth элементов вперёд: пока потребитель
+    обрабатывает батч N, следующие уже читаются и парсятся.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(msg) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(msg, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in it:
+                if not put(("item", item)):
+                    return
+            put(("done", None))
+        except BaseException as e:
+            put(("error", e))
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            kind, val = q.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise val
+            yield val
+    finally:
+        # потребитель вышел раньше (ошибка/break) — отпускаем producer
+        stop.set()
+        worker.join()
+
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PG_EPOCH = np.datetime64("2000-01-01", "D")
+COPY_SLICE_ROWS = 50_000
+# сколько байт copy_expert читает из pipe за раз (по умолчанию 8 КБ)
+COPY_READ_SIZE = 1 << 20
+
+
+def pgcopy_column(s: pd.Series):
+    """
+    Одна колонка -> (длины полей, payload) в формате COPY BINARY.
+    date -> int32 дней от 2000-01-01, целые -> int64 (bigint), остальное -> UTF-8 text.
+    NULL кодируется длиной -1 без payload.
+    """
+    vals = s.to_numpy()
+    null = pd.isna(s).to_numpy()
+    first = s[~null].iloc[0] if (~null).any() else None
+
+    if pd.api.types.is_datetime64_any_dtype(s) or isinstance(first, dt.date):
+        # datetime64 уже int64 под капотом — день для PG date = сдвиг от 2000-01-01
+        raw = s.to_numpy() if pd.api.types.is_datetime64_any_dtype(s) else pd.to_datetime(s).to_numpy()
+        days = raw.astype("datetime64[D]")
+        days = (days[~null] - PG_EPOCH).astype(">i4")
+        payload = days.view(np.uint8)
+        width = 4
+    elif pd.api.types.is_integer_dtype(s):
+        payload = vals[~null].astype(">i8").view(np.uint8)
+        width = 8
+    else:
+        enc = [str(v).encode("utf-8") for v in vals[~null]]
+        lens = np.full(len(s), -1, dtype=np.int64)
+        lens[~null] = np.fromiter(map(len, enc), dtype=np.int64, count=len(enc))
+        return lens, np.frombuffer(b"".join(enc), dtype=np.uint8)
+
+    lens = np.where(null, -1, width).astype(np.int64)
+    return lens, payload
+
+
+def df_to_pgcopy_rows(df: pd.DataFrame) -> memoryview:
+    """
+    DataFrame -> строки COPY BINARY (без заголовка PGCOPY и трейлера).
+    Собирается по колонкам через numpy, без построчного форматирования.
+    Возвращает view на numpy-буфер — без лишней копии в bytes.
+    """
+    n = len(df)
+    cols = [pgcopy_column(df[c]) for c in df.columns]
+
+    # строка: int16 кол-во полей + на каждое поле int32 длина + payload
+    row_len = np.full(n, 2, dtype=np.int64)
+    for lens, _ in cols:
+        row_len += 4 + np.maximum(lens, 0)
+
+    row_start = np.cumsum(row_len) - row_len
+    out = np.empty(int(row_len.sum()), dtype=np.uint8)
+
+    def put(pos, data, width):
+        out[pos[:, None] + np.arange(width)] = data.reshape(-1, width)
+
+    put(row_start, np.full(n, len(cols), dtype=">i2").view(np.uint8), 2)
+    pos = row_start + 2
+
+    for lens, payload in cols:
+        put(pos, lens.astype(">i4").view(np.uint8), 4)
+        pos = pos + 4
+
+        has = lens > 0
+        plen = lens[has]
+        if len(payload):
+            src_start = np.cumsum(plen) - plen
+            idx = np.repeat(pos[has] - src_start, plen) + np.arange(len(payload))
+            out[idx] = payload
+        pos = pos + np.maximum(lens, 0)
+
+    return out.data
 
 
 def copy_df_to_table(conn, df: pd.DataFrame, table: str):
     """
-    COPY df -> table (Postgres) через psycopg2 copy_expert.
+    COPY df -> table (Postgres) через psycopg2 copy_expert в формате BINARY.
+    copy_expert читает из pipe в отдельном потоке, а df кодируется кусками по
+    COPY_SLICE_ROWS строк — COPY начинается до того, как закодирован весь df.
     conn: SQLAlchemy Connection (внутри engine.begin()).
     """
     raw = conn.connection  # psycopg2 connection
-    cur = raw.cursor()
-
-    buf = io.StringIO()
-    df.to_csv(buf, index=False, header=False)
-    buf.seek(0)
 
     cols = ",".join(df.columns)
-    sql = f"COPY {table} ({cols}) FROM STDIN WITH (FORMAT CSV)"
+    sql = f"COPY {table} ({cols}) FROM STDIN WITH (FORMAT BINARY)"
+
+    r, w = os.pipe()
+    errors = []
+
+    def consume():
+        with os.fdopen(r, "rb") as reader:
+            try:
+                cur = raw.cursor()
+                cur.copy_expert(sql, reader, size=COPY_READ_SIZE)
+                cur.close()
+            except BaseException as e:
+                errors.append(e)
+
+    worker = threading.Thread(target=consume, daemon=True)
+    worker.start()
+    try:
+        with os.fdopen(w, "wb") as writer:
+            writer.write(PGCOPY_HEADER)
+            for start in range(0, len(df), COPY_SLICE_ROWS):
+                writer.write(df_to_pgcopy_rows(df.iloc[start:start + COPY_SLICE_ROWS]))
+            writer.write(PGCOPY_TRAILER)
+    except BrokenPipeError:
+        pass  # COPY упал на стороне читателя — ошибку поднимаем ниже
+    finally:
+        worker.join()
+
+    if errors:
+        raise errors[0]
+
+
+def count_clicks(days: np.ndarray, subids: pd.Series) -> pd.DataFrame:
+    """
+    (day, subid) -> clicks без pandas groupby: factorize + bincount по составному ключу.
+    days: datetime64[D], строки с NaT отбрасываются.
+    subids: колонка как есть (Arrow string) — factorize по Arrow-буферу, python str
+    создаются только для уникальных subid.
+    """
+    ok = ~np.isnat(days)
+    codes_sub, uniq_sub = pd.factorize(subids[ok], sort=False)
+    uniq_day, codes_day = np.unique(days[ok], return_inverse=True)
+
+    ok_sub = codes_sub >= 0
+    key = codes_day[ok_sub].astype(np.int64) * len(uniq_sub) + codes_sub[ok_sub]
+    counts = np.bincount(key)
 
-    cur.copy_expert(sql, buf)
-    cur.close()
+    nz = np.flatnonzero(counts)
+    day_idx, sub_idx = np.divmod(nz, len(uniq_sub))
+    return pd.DataFrame({"day": uniq_day[day_idx], "subid": uniq_sub[sub_idx], "clicks": counts[nz]})
 
 
 def pct_change(curr: float, prev: float):
@@ -109,18 +348,23 @@ def fmt_pct_cell(val):
     return f"{sign}{val:.2f}%"
 
 
-def style_pct_color(val):
-    if val is None or pd.isna(val):
-        return ""
-    if val > 0:
-        return "color: #22c55e; font-weight: 700;"
-    if val < 0:
-        return "color: #ef4444; font-weight: 700;"
-    return "color: #a3a3a3;"
+def style_pct_color(col: pd.Series) -> np.ndarray:
+    """Цвет Δ% сразу для всей колонки (Styler.apply), без вызова на каждую ячейку."""
+    v = pd.to_numeric(col, errors="coerce").to_numpy(dtype=float)
+    return np.select(
+        [np.isnan(v), v > 0, v < 0],
+        ["", "color: #22c55e; font-weight: 700;", "color: #ef4444; font-weight: 700;"],
+        default="color: #a3a3a3;",
+    )
 
 
 # ===================== Schema bootstrap =====================
+@st.cache_resource
 def ensure_schema():
+    """
+    DDL один раз на процесс, а не на каждый rerun: даже "if not exists" берёт блокировки
+    (create index — ShareLock), которые ждали бы refresh mv_daily_rollup.
+    """
     with engine.begin() as conn:
         conn.execute(
             text(
@@ -147,17 +391,8 @@ def ensure_schema():
                 """
             )
         )
-        conn.execute(
-            text(
-                """
-                create table if not exists staging_clicks_daily (
-                  day date not null,
-                  subid text not null,
-                  clicks bigint not null
-                );
-                """
-            )
-        )
+        # staging для clicks теперь TEMP (stg_clicks) — общая таблица больше не нужна
+        conn.execute(text("drop table if exists staging_clicks_daily;"))
         conn.execute(
             text(
                 """
@@ -178,205 +413,368 @@ def ensure_schema():
         conn.execute(text("create index if not exists idx_dim_subid_campaign on dim_subid(campaign);"))
         conn.execute(text("create index if not exists idx_dim_subid_offer on dim_subid(offer);"))
 
+        # нормализованные разрезы дашборда — generated-колонки: Postgres считает их при
+        # записи строки, ни загрузчику, ни дашборду пересчитывать не нужно
+        norm = conn.execute(
+            text(
+                """
+                select is_generated from information_schema.columns
+                where table_name = 'dim_subid' and column_name = 'sub2_norm';
+                """
+            )
+        ).first()
+        if norm is None or norm[0] != "ALWAYS":
+            # mv_daily_rollup зависит от этих колонок (а старая версия — от сырых sub_id_2/campaign)
+            conn.execute(text("drop materialized view if exists mv_daily_rollup;"))
+            conn.execute(
+                text("alter table dim_subid drop column if exists campaign_short, drop column if exists sub2_norm;")
+            )
+            conn.execute(
+                text(
+                    """
+                    alter table dim_subid
+                      add column campaign_short text
+                        generated always as (trim(split_part(coalesce(campaign, ''), '[', 1))) stored,
+                      add column sub2_norm text
+                        generated always as (coalesce(nullif(trim(sub_id_2), ''), 'Organic')) stored;
+                    """
+                )
+            )
+        conn.execute(text("create index if not exists idx_dim_subid_sub2_norm on dim_subid(sub2_norm);"))
+        conn.execute(text("create index if not exists idx_dim_subid_campaign_short on dim_subid(campaign_short);"))
+
+        # дневной rollup по разрезам дашборда — обновляется после каждой загрузки.
+        # Существование проверяем через to_regclass: DDL на MV ждал бы refresh concurrently
+        if conn.execute(text("select to_regclass('mv_daily_rollup')")).scalar() is None:
+            conn.execute(
+                text(
+                    """
+                    create materialized view if not exists mv_daily_rollup as
+                    with f as (
+                      select day, subid, clicks, 0::bigint as leads, 0::bigint as sales
+                      from fact_clicks_daily
+                      union all
+                      select day, subid, 0::bigint, leads, sales
+                      from fact_conversions_daily
+                    )
+                    select
+                      f.day,
+                      coalesce(d.sub2_norm, 'Organic') as sub2_norm,
+                      coalesce(d.campaign_short, '') as campaign_short,
+                      coalesce(trim(d.offer), '') as offer,
+                      sum(f.clicks)::bigint as clicks,
+                      sum(f.leads)::bigint as leads,
+                      sum(f.sales)::bigint as sales
+                    from f
+                    left join dim_subid d
+                      on d.subid = f.subid
+                    group by 1, 2, 3, 4
+                    with data;
+                    """
+                )
+            )
+        if conn.execute(text("select to_regclass('ux_mv_daily_rollup')")).scalar() is None:
+            # unique index обязателен для refresh ... concurrently
+            conn.execute(
+                text(
+                    "create unique index if not exists ux_mv_daily_rollup "
+                    "on mv_daily_rollup(day, sub2_norm, campaign_short, offer);"
+                )
+            )
+
 
 ensure_schema()
 
 
 # ===================== Loaders =====================
+CLICKS_BLOCK_SIZE = 16 << 20  # байт CSV на один чанк pyarrow
+CLICKS_FLUSH_CHUNKS = 16
+PROGRESS_EVERY_S = 2.0  # прогресс-бар обновляем не чаще, каждый вызов — сообщение в браузер
+
+
+# SQL загрузки clicks — text() собираем один раз при импорте
+SQL_ASYNC_COMMIT = text("set local synchronous_commit = off")
+# загрузки clicks идут по очереди: иначе delete дня во второй загрузке не видит строк,
+# вставленных первой, и replace_day оставляет в дне смесь обоих файлов
+SQL_LOCK_CLICKS_LOAD = text("select pg_advisory_xact_lock(hashtext('fact_clicks_daily'))")
+SQL_DELETE_CLICKS_DAY = text("delete from fact_clicks_daily where day = :d")
+SQL_DROP_STG_CLICKS = text("drop table if exists stg_clicks;")
+# TEMP-таблица и так не пишет WAL (UNLOGGED с TEMP в Postgres не сочетается)
+SQL_CREATE_STG_CLICKS = text(
+    """
+    create temporary table stg_clicks (
+      day date,
+      subid text,
+      clicks bigint
+    ) on commit drop;
+    """
+)
+# один upsert на всю загрузку: в stg_clicks частичные агрегаты всех flush, group by сводит
+# их в итог по (day, subid) — повторная загрузка того же файла даёт тот же результат
+# additive
+SQL_UPSERT_CLICKS_APPEND = text(
+    """
+    insert into fact_clicks_daily(day, subid, clicks)
+    select day, subid, sum(clicks)
+    from stg_clicks
+    group by day, subid
+    on conflict (day, subid)
+    do update set clicks = fact_clicks_daily.clicks + excluded.clicks;
+    """
+)
+# replace (idempotent) — просто перезаписываем значения
+SQL_UPSERT_CLICKS_REPLACE = text(
+    """
+    insert into fact_clicks_daily(day, subid, clicks)
+    select day, subid, sum(clicks)
+    from stg_clicks
+    group by day, subid
+    on conflict (day, subid)
+    do update set clicks = excluded.clicks;
+    """
+)
+
+
+def stage_clicks(conn, parts: list[pd.DataFrame]):
+    """
+    Сливает накопленные агрегаты чанков в один и COPY в stg_clicks.
+    В fact_clicks_daily не пишет: это делает один upsert в load_clicks после всего файла.
+    """
+    parts = [p for p in parts if not p.empty]
+    if not parts:
+        return
+
+    agg = pd.concat(parts, ignore_index=True)
+    if len(parts) > 1:
+        agg = agg.groupby(["day", "subid"], sort=False, as_index=False)["clicks"].sum()
+
+    copy_df_to_table(conn, agg[["day", "subid", "clicks"]], "stg_clicks")
+
+
+ClickCols = namedtuple("ClickCols", "time subid offer flag os sub2 camp sub1")
+
+
+def resolve_click_cols(header: pd.DataFrame) -> ClickCols:
+    return ClickCols(
+        time=pick_col(header, ["Время клика", "Дата и время", "Click time", "Click Time"]),
+        subid=pick_col(header, ["Subid", "SubId", "subid", "SUBID"]),
+        # доп. поля из click.csv
+        offer=pick_col(header, ["Оффер", "Offer"]),
+        flag=pick_col(header, ["Флаг страны", "Country flag", "Flag"]),
+        os=pick_col(header, ["ОС", "OS"]),
+        sub2=pick_col(header, ["Sub ID 2", "Subid 2", "Sub2", "Sub ID2"]),
+        camp=pick_col(header, ["Кампания", "Campaign"]),
+        sub1=pick_col(header, ["Sub ID 1", "Subid 1", "Sub1", "Sub ID1"]),
+    )
+
+
+DIM_COLS = ["subid", "offer", "country_flag", "os", "sub_id_2", "campaign", "sub_id_1"]
+
+
+def merge_dim(conn, dim: pd.DataFrame):
+    """
+    Один COPY всех атрибутов subid за файл во TEMP staging + один UPDATE/INSERT в dim_subid.
+    """
+    conn.execute(text("drop table if exists staging_dim_subid_tmp;"))
+    conn.execute(
+        text(
+            """
+            create temporary table staging_dim_subid_tmp (
+              subid text,
+              offer text,
+              country_flag text,
+              os text,
+              sub_id_2 text,
+              campaign text,
+              sub_id_1 text
+            ) on commit drop;
+            """
+        )
+    )
+    if dim.empty:
+        return
+
+    copy_df_to_table(conn, dim[DIM_COLS], "staging_dim_subid_tmp")
+
+    conn.execute(
+        text(
+            """
+            update dim_subid d
+            set
+              offer = coalesce(nullif(s.offer,''), d.offer),
+              country_flag = coalesce(nullif(s.country_flag,''), d.country_flag),
+              os = coalesce(nullif(s.os,''), d.os),
+              sub_id_2 = coalesce(nullif(s.sub_id_2,''), d.sub_id_2),
+              campaign = coalesce(nullif(s.campaign,''), d.campaign),
+              sub_id_1 = coalesce(nullif(s.sub_id_1,''), d.sub_id_1),
+              updated_at = now()
+            from staging_dim_subid_tmp s
+            where d.subid = s.subid;
+            """
+        )
+    )
+
+    conn.execute(
+        text(
+            """
+            insert into dim_subid(subid, offer, country_flag, os, sub_id_2, campaign, sub_id_1)
+            select s.subid, s.offer, s.country_flag, s.os, s.sub_id_2, s.campaign, s.sub_id_1
+            from staging_dim_subid_tmp s
+            left join dim_subid d on d.subid = s.subid
+            where d.subid is null;
+            """
+        )
+    )
+
+
 def load_clicks(file, mode: str = "replace_day"):
     """
     mode:
       - replace_day: безопасно (idempotent) — перед загрузкой дня очищаем clicks за этот day
       - append: добавляет к существующим (если грузишь кусками/несколько файлов на один день)
     """
-    st.write("🧩 start_load_clicks")
+    debug_write("🧩 start_load_clicks")
 
-    df_iter = pd.read_csv(
-        file,
-        sep=";",
-        encoding="utf-8-sig",
-        engine="python",
-        chunksize=200_000,
+    # колонки одинаковы для всех чанков файла — резолвим один раз по заголовку
+    cols = resolve_click_cols(read_csv_ru_header(file))
+
+    # чтение + парсинг следующих батчей идут в фоне, пока текущий агрегируется
+    df_iter = prefetch(
+        iter_csv_ru_batches(file, block_size=CLICKS_BLOCK_SIZE, columns=list(dict.fromkeys(cols)))
     )
-    st.write("🧩 csv iterator created")
+    debug_write("🧩 csv iterator created")
 
     chunks_done = 0
     total_rows = 0
     progress = st.progress(0)
+    last_progress = time.monotonic()
 
     detected_day = None
-
-    with engine.begin() as conn:
+    pending = []
+    dim_parts = []
+
+    # COPY пачек в stg_clicks уходит в фоновый поток, пока главный парсит следующие чанки.
+    # Один воркер: всё в одной транзакции (replace_day delete + загрузка атомарны),
+    # а соединение в каждый момент использует только один поток.
+    with engine.begin() as conn, ThreadPoolExecutor(max_workers=1) as db_writer:
+        # весь файл — одна транзакция, которую при сбое просто перезальём из CSV:
+        # fsync WAL на коммите не ждём
+        conn.execute(SQL_ASYNC_COMMIT)
+        conn.execute(SQL_LOCK_CLICKS_LOAD)
+        conn.execute(SQL_DROP_STG_CLICKS)
+        conn.execute(SQL_CREATE_STG_CLICKS)
+        flush = None
+        time_fmt = None
         for chunk in df_iter:
             chunks_done += 1
+            if chunks_done == 1:
+                time_fmt = detect_datetime_format(chunk[cols.time])
 
-            time_col = pick_col(chunk, ["Время клика", "Дата и время", "Click time", "Click Time"])
-            subid_col = pick_col(chunk, ["Subid", "SubId", "subid", "SUBID"])
-
-            # доп. поля из click.csv
-            offer_col = pick_col(chunk, ["Оффер", "Offer"])
-            flag_col = pick_col(chunk, ["Флаг страны", "Country flag", "Flag"])
-            os_col = pick_col(chunk, ["ОС", "OS"])
-            sub2_col = pick_col(chunk, ["Sub ID 2", "Subid 2", "Sub2", "Sub ID2"])
-            camp_col = pick_col(chunk, ["Кампания", "Campaign"])
-            sub1_col = pick_col(chunk, ["Sub ID 1", "Subid 1", "Sub1", "Sub ID1"])
-
-            chunk["day"] = pd.to_datetime(chunk[time_col], errors="coerce").dt.date
-            chunk["subid"] = chunk[subid_col].astype(str)
+            # datetime64[D] вместо .dt.date — без python date-объектов на каждую строку
+            days = parse_datetime(chunk[cols.time], time_fmt).to_numpy().astype("datetime64[D]")
 
             # Определяем день файла на первом чанке
             if detected_day is None:
-                detected_day = chunk["day"].dropna().min()
-                if detected_day is not None and mode == "replace_day":
-                    st.write(f"🧹 replace_day: очищаю clicks за {detected_day}")
-                    conn.execute(text("delete from fact_clicks_daily where day = :d"), {"d": detected_day})
-
-            # -------- DIM (subid -> attrs) через TEMP staging --------
-            dim = chunk[[subid_col, offer_col, flag_col, os_col, sub2_col, camp_col, sub1_col]].copy()
-            dim.columns = ["subid", "offer", "country_flag", "os", "sub_id_2", "campaign", "sub_id_1"]
-            dim["subid"] = dim["subid"].astype(str)
-
-            dim = dim[dim["subid"].notna() & (dim["subid"].astype(str).str.len() > 0)]
-            dim = dim.drop_duplicates(subset=["subid"], keep="last")
-
-            conn.execute(text("drop table if exists staging_dim_subid_tmp;"))
-            conn.execute(
-                text(
-                    """
-                    create temporary table staging_dim_subid_tmp (
-                      subid text,
-                      offer text,
-                      country_flag text,
-                      os text,
-                      sub_id_2 text,
-                      campaign text,
-                      sub_id_1 text
-                    ) on commit drop;
-                    """
-                )
-            )
-            if not dim.empty:
-                copy_df_to_table(
-                    conn,
-                    dim[["subid", "offer", "country_flag", "os", "sub_id_2", "campaign", "sub_id_1"]],
-                    "staging_dim_subid_tmp",
-                )
-
-                conn.execute(
-                    text(
-                        """
-                        update dim_subid d
-                        set
-                          offer = coalesce(nullif(s.offer,''), d.offer),
-                          country_flag = coalesce(nullif(s.country_flag,''), d.country_flag),
-                          os = coalesce(nullif(s.os,''), d.os),
-                          sub_id_2 = coalesce(nullif(s.sub_id_2,''), d.sub_id_2),
-                          campaign = coalesce(nullif(s.campaign,''), d.campaign),
-                          sub_id_1 = coalesce(nullif(s.sub_id_1,''), d.sub_id_1),
-                          updated_at = now()
-                        from staging_dim_subid_tmp s
-                        where d.subid = s.subid;
-                        """
-                    )
-                )
-
-                conn.execute(
-                    text(
-                        """
-                        insert into dim_subid(subid, offer, country_flag, os, sub_id_2, campaign, sub_id_1)
-                        select s.subid, s.offer, s.country_flag, s.os, s.sub_id_2, s.campaign, s.sub_id_1
-                        from staging_dim_subid_tmp s
-                        left join dim_subid d on d.subid = s.subid
-                        where d.subid is null;
-                        """
-                    )
-                )
+                valid_days = days[~np.isnat(days)]
+                if len(valid_days):
+                    detected_day = valid_days.min().item()
+                    if mode == "replace_day":
+                        st.write(f"🧹 replace_day: очищаю clicks за {detected_day}")
+                        # день может найтись и на позднем чанке, когда db_writer уже пишет в conn
+                        if flush is not None:
+                            flush.result()
+                        conn.execute(SQL_DELETE_CLICKS_DAY, {"d": detected_day})
+
+            # -------- DIM (subid -> attrs): копим по чанкам, в БД — один раз после цикла --------
+            # колонки уже строковые (Arrow): фильтр и выборка одним .loc, без .copy() и astype
+            sub = chunk[cols.subid]
+            dim = chunk.loc[
+                sub.notna() & (sub.str.len() > 0),
+                [cols.subid, cols.offer, cols.flag, cols.os, cols.sub2, cols.camp, cols.sub1],
+            ].set_axis(DIM_COLS, axis=1)
+            # last() берёт последнее непустое значение по каждой колонке, а не последнюю строку целиком
+            dim_parts.append(dim.groupby("subid", sort=False).last().reset_index())
 
             # -------- FACT clicks --------
             # если mode=replace_day, всё равно безопасно: мы уже удалили day и заново заливаем
-            agg = (
-                chunk.dropna(subset=["day", "subid"])
-                .groupby(["day", "subid"])
-                .size()
-                .reset_index(name="clicks")
-            )
+            agg = count_clicks(days, chunk[cols.subid])
+            pending.append(agg)
 
             total_rows += len(chunk)
-            st.write(f"⬆️ chunk #{chunks_done}: прочитал {total_rows:,} строк, аггрегировал {len(agg):,}…")
+            debug_write(f"⬆️ chunk #{chunks_done}: прочитал {total_rows:,} строк, аггрегировал {len(agg):,}…")
 
-            if agg.empty:
-                continue
+            # COPY в staging раз в CLICKS_FLUSH_CHUNKS чанков, а не на каждый
+            if chunks_done % CLICKS_FLUSH_CHUNKS == 0:
+                if flush is not None:
+                    flush.result()
+                flush = db_writer.submit(stage_clicks, conn, pending)
+                pending = []
 
-            conn.execute(text("truncate staging_clicks_daily;"))
-            copy_df_to_table(conn, agg[["day", "subid", "clicks"]], "staging_clicks_daily")
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_EVERY_S:
+                progress.progress(min(0.99, chunks_done / 20))
+                last_progress = now
 
-            if mode == "append":
-                # additive
-                conn.execute(
-                    text(
-                        """
-                        insert into fact_clicks_daily(day, subid, clicks)
-                        select day, subid, clicks
-                        from staging_clicks_daily
-                        on conflict (day, subid)
-                        do update set clicks = fact_clicks_daily.clicks + excluded.clicks;
-                        """
-                    )
-                )
-            else:
-                # replace (idempotent) — просто перезаписываем значения
-                conn.execute(
-                    text(
-                        """
-                        insert into fact_clicks_daily(day, subid, clicks)
-                        select day, subid, clicks
-                        from staging_clicks_daily
-                        on conflict (day, subid)
-                        do update set clicks = excluded.clicks;
-                        """
-                    )
-                )
+        if flush is not None:
+            flush.result()
+        stage_clicks(conn, pending)
+        conn.execute(SQL_UPSERT_CLICKS_APPEND if mode == "append" else SQL_UPSERT_CLICKS_REPLACE)
 
-            progress.progress(min(0.99, chunks_done / 20))
+        if dim_parts:
+            merge_dim(conn, pd.concat(dim_parts, ignore_index=True).groupby("subid", sort=False).last().reset_index())
 
     progress.progress(1.0)
     st.write(f"🎉 clicks загружены, всего исходных строк: {total_rows:,}")
 
 
-def load_conversions(file):
-    st.write("🧩 start_load_conversions")
+ConvCols = namedtuple("ConvCols", "subid status conv_time sale_time")
 
-    df = read_csv_ru(file)
 
-    subid_col = pick_col(df, ["Subid", "SubId", "subid", "SUBID"])
-    status_col = pick_col(df, ["Ориг. статус", "Orig. status", "Orig status", "Status"])
-    conv_time_col = pick_col(df, ["Время конверсии", "Conversion time"])
+def resolve_conv_cols(header: pd.DataFrame) -> ConvCols:
+    """Все колонки conv.csv за один проход; sale_time необязательна (None)."""
+    try:
+        sale_time = pick_col(header, ["Время продажи", "Sale time"])
+    except KeyError:
+        sale_time = None
+    return ConvCols(
+        subid=pick_col(header, ["Subid", "SubId", "subid", "SUBID"]),
+        status=pick_col(header, ["Ориг. статус", "Orig. status", "Orig status", "Status"]),
+        conv_time=pick_col(header, ["Время конверсии", "Conversion time"]),
+        sale_time=sale_time,
+    )
 
-    sale_time_col = None
-    for cand in ["Время продажи", "Sale time"]:
-        try:
-            sale_time_col = pick_col(df, [cand])
-            break
-        except Exception:
-            pass
 
-    df["subid"] = df[subid_col].astype(str)
-    df["_status"] = df[status_col].astype(str).str.lower()
+# до стольких строк conversions пишем одним INSERT ... unnest, дальше — через COPY.
+# psycopg2 подставляет массивы в текст запроса на клиенте, так что это только для мелких файлов
+CONV_UNNEST_MAX_ROWS = 500
 
-    df["day_lead"] = pd.to_datetime(df[conv_time_col], errors="coerce").dt.date
 
+def load_conversions(file):
+    debug_write("🧩 start_load_conversions")
+
+    df = read_csv_ru(file)
+    subid_col, status_col, conv_time_col, sale_time_col = resolve_conv_cols(df)
+
+    df["subid"] = df[subid_col]
+    # lower() только по уникальным статусам, дальше сравниваем int-коды
+    status_codes, status_uniques = pd.factorize(df[status_col])
+    status_lower = pd.Index(status_uniques).astype(str).str.lower()
+    is_lead = np.isin(status_codes, np.flatnonzero(status_lower == "lead"))
+    is_sale = np.isin(status_codes, np.flatnonzero(status_lower == "sale"))
+
+    # floor до дня остаётся datetime64 — без python date-объектов на каждую строку
+    conv_ts = parse_datetime(df[conv_time_col], detect_datetime_format(df[conv_time_col]))
+    df["day_lead"] = conv_ts.dt.floor("D")
+
+    # время продажи парсим один раз; пустое/битое -> NaT -> берём уже распарсенное время конверсии
     if sale_time_col:
-        sale_time = df[sale_time_col].where(
-            df[sale_time_col].notna() & (df[sale_time_col].astype(str) != ""),
-            df[conv_time_col],
-        )
+        sale_ts = parse_datetime(df[sale_time_col], detect_datetime_format(df[sale_time_col]))
+        df["day_sale"] = sale_ts.fillna(conv_ts).dt.floor("D")
     else:
-        sale_time = df[conv_time_col]
-
-    df["day_sale"] = pd.to_datetime(sale_time, errors="coerce").dt.date
+        df["day_sale"] = df["day_lead"]
 
     leads = (
-        df[df["_status"] == "lead"]
+        df[is_lead]
         .dropna(subset=["day_lead", "subid"])
         .groupby(["day_lead", "subid"])
         .size()
@@ -385,7 +783,7 @@ def load_conversions(file):
     )
 
     sales = (
-        df[df["_status"] == "sale"]
+        df[is_sale]
         .dropna(subset=["day_sale", "subid"])
         .groupby(["day_sale", "subid"])
         .size()
@@ -399,57 +797,74 @@ def load_conversions(file):
         .astype({"leads": int, "sales": int})
     )
 
-    st.write(f"🧪 conversions aggregated rows: {len(merged):,}")
+    debug_write(f"🧪 conversions aggregated rows: {len(merged):,}")
 
     with engine.begin() as conn:
-        conn.execute(text("drop table if exists staging_conversions_tmp;"))
-        conn.execute(
-            text(
-                """
-                create temporary table staging_conversions_tmp (
-                  day date,
-                  subid text,
-                  leads bigint,
-                  sales bigint
-                ) on commit drop;
-                """
+        conn.execute(SQL_ASYNC_COMMIT)
+        if len(merged) <= CONV_UNNEST_MAX_ROWS:
+            # мелкий файл: один INSERT ... unnest(...) вместо TEMP + COPY + UPSERT (4 round-trip)
+            if not merged.empty:
+                conn.execute(
+                    text(
+                        """
+                        insert into fact_conversions_daily(day, subid, leads, sales)
+                        select * from unnest(
+                          cast(:days as date[]), cast(:subids as text[]),
+                          cast(:leads as bigint[]), cast(:sales as bigint[])
+                        )
+                        on conflict (day, subid)
+                        do update set leads = excluded.leads, sales = excluded.sales;
+                        """
+                    ),
+                    {
+                        "days": merged["day"].dt.date.tolist(),
+                        "subids": merged["subid"].tolist(),
+                        "leads": merged["leads"].tolist(),
+                        "sales": merged["sales"].tolist(),
+                    },
+                )
+        else:
+            conn.execute(text("drop table if exists staging_conversions_tmp;"))
+            conn.execute(
+                text(
+                    """
+                    create temporary table staging_conversions_tmp (
+                      day date,
+                      subid text,
+                      leads bigint,
+                      sales bigint
+                    ) on commit drop;
+                    """
+                )
             )
-        )
 
-        if not merged.empty:
             copy_df_to_table(conn, merged[["day", "subid", "leads", "sales"]], "staging_conversions_tmp")
 
-        # UPDATE существующих
-        conn.execute(
-            text(
-                """
-                update fact_conversions_daily f
-                set
-                  leads = s.leads,
-                  sales = s.sales
-                from staging_conversions_tmp s
-                where f.day = s.day and f.subid = s.subid;
-                """
-            )
-        )
-
-        # INSERT новых
-        conn.execute(
-            text(
-                """
-                insert into fact_conversions_daily(day, subid, leads, sales)
-                select s.day, s.subid, s.leads, s.sales
-                from staging_conversions_tmp s
-                left join fact_conversions_daily f
-                  on f.day = s.day and f.subid = s.subid
-                where f.subid is null;
-                """
+            # UPSERT одним проходом по PK вместо UPDATE + INSERT ... LEFT JOIN
+            conn.execute(
+                text(
+                    """
+                    insert into fact_conversions_daily(day, subid, leads, sales)
+                    select s.day, s.subid, s.leads, s.sales
+                    from staging_conversions_tmp s
+                    on conflict (day, subid)
+                    do update set leads = excluded.leads, sales = excluded.sales;
+                    """
+                )
             )
-        )
 
     st.write("🎉 conversions загружены")
 
 
+def refresh_rollup():
+    """Пересчёт mv_daily_rollup без блокировки читателей дашборда."""
+    with engine.begin() as conn:
+        conn.execute(SQL_ASYNC_COMMIT)
+        # concurrently сравнивает старое и новое содержимое MV — больше памяти под hash/sort
+        conn.execute(text("set local work_mem = '256MB'"))
+        conn.execute(text("refresh materialized view concurrently mv_daily_rollup;"))
+
+
 # ===================== UI =====================
 st.title("📊 KT dashboard")
 st.caption("build: 2025-12-23 v4.1 (% gainers + NEW + dim_subid)")
@@ -465,6 +880,7 @@ with st.sidebar:
         index=0,
         help="replace_day — безопасно (можно загружать один и тот же файл повторно). append — складывает клики (только если точно нужно).",
     )
+    st.checkbox("Debug-лог загрузки", key="debug")
 
     if st.button("Загрузить в БД", type="primary"):
         with st.spinner("Загружаю данные в базу..."):
@@ -478,75 +894,108 @@ with st.sidebar:
                 load_conversions(conv_file)
                 st.write("✅ conversions загружены")
 
+            if clicks_file or conv_file:
+                st.write("🔄 Обновляю mv_daily_rollup...")
+                refresh_rollup()
+
         st.success("🎉 Данные успешно загружены в БД")
         st.cache_data.clear()
         st.rerun()
 
 
 # ===================== Data for dashboard =====================
-@st.cache_data(ttl=600)
-def load_dashboard_df():
-    SQL_DASH = """
-    with keys as (
-      select day, subid from fact_clicks_daily
-      union
-      select day, subid from fact_conversions_daily
-    )
-    select
-      k.day,
-      k.subid,
-      coalesce(c.clicks, 0) as clicks,
-      coalesce(v.leads, 0) as leads,
-      coalesce(v.sales, 0) as sales,
-      d.offer,
-      d.country_flag,
-      d.os,
-      d.sub_id_2,
-      d.campaign,
-      d.sub_id_1
-    from keys k
-    left join fact_clicks_daily c
-      on c.day = k.day and c.subid = k.subid
-    left join fact_conversions_daily v
-      on v.day = k.day and v.subid = k.subid
-    left join dim_subid d
-      on d.subid = k.subid
-    where k.day >= current_date - interval '30 days'
-    order by k.day;
-    """
-    return pd.read_sql(SQL_DASH, engine)
-
-df = load_dashboard_df()
-
-if df.empty:
-    st.info("Загрузи CSV файлы — появится дашборд.")
-    st.stop()
+def dashboard_version():
+    """
+    Дешёвый probe по mv_daily_rollup (дашборд читает только её): max(day) по
+    уникальному индексу + счётчик изменённых строк из pg_stat — меняется после
+    каждого refresh. Ключ кэша, чтобы не гонять тяжёлые запросы на каждом rerun.
+    """
+    with read_engine.connect() as conn:
+        return tuple(
+            conn.execute(
+                text(
+                    """
+                    select
+                      (select max(day) from mv_daily_rollup),
+                      (select n_tup_ins + n_tup_upd + n_tup_del
+                       from pg_stat_user_tables
+                       where relid = 'mv_daily_rollup'::regclass);
+                    """
+                )
+            ).one()
+        )
 
-# Нормализация разрезов
-df["sub_id_2"] = df["sub_id_2"].fillna("").astype(str).str.strip()
-df["sub2_norm"] = df["sub_id_2"].replace({"": "Organic"})
 
-df["campaign"] = df["campaign"].fillna("").astype(str)
-df["campaign_short"] = df["campaign"].str.split("[", n=1).str[0].str.strip()
+@st.cache_data(ttl=300, show_spinner=False)
+def load_daily_totals(version):
+    """Суммы по дням за 30 дней — для KPI и графика (D строк вместо D × subid)."""
+    SQL_DAILY = """
+    select day, sum(clicks)::bigint as clicks, sum(leads)::bigint as leads, sum(sales)::bigint as sales
+    from mv_daily_rollup
+    where day >= current_date - interval '30 days'
+    group by day
+    order by day;
+    """
+    return pd.read_sql(SQL_DAILY, read_engine)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_dashboard_df(version, yday: dt.date, pday: dt.date):
+    """
+    Только вчера/позавчера из mv_daily_rollup, уже свёрнутые до разрезов дашборда
+    (sub2_norm × campaign_short × offer) — subid в pandas не нужен.
+    """
+    SQL_DASH = """
+    select day, sub2_norm, campaign_short, offer, clicks, leads, sales
+    from mv_daily_rollup
+    where day in (:yday, :pday);
+    """
+    return pd.read_sql(
+        text(SQL_DASH),
+        read_engine,
+        params={"yday": yday, "pday": pday},
+        dtype={
+            "sub2_norm": "category",
+            "campaign_short": "category",
+            "offer": "category",
+            # bigint в MV — int64: astype в int32 при переполнении молча заворачивается
+            "clicks": "int64",
+            "leads": "int64",
+            "sales": "int64",
+        },
+    )
 
-df["offer"] = df["offer"].fillna("").astype(str).str.strip()
 
 # Периоды: вчера / позавчера
 today = dt.date.today()
 yday = today - dt.timedelta(days=1)
 pday = today - dt.timedelta(days=2)
 
-df_y = df[df["day"] == yday].copy()
-df_p = df[df["day"] == pday].copy()
+version = dashboard_version()
+daily = load_daily_totals(version)
 
-y_clicks = int(df_y["clicks"].sum())
-p_clicks = int(df_p["clicks"].sum())
+if daily.empty:
+    st.info("Загрузи CSV файлы — появится дашборд.")
+    st.stop()
+
+df = load_dashboard_df(version, yday, pday)
+
+# срезы только читаются ниже — без .copy()
+df_y = df.loc[df["day"].eq(yday)]
+df_p = df.loc[df["day"].eq(pday)]
+
+daily_by_day = daily.set_index("day")
+totals_y = daily_by_day.reindex([yday], fill_value=0).iloc[0]
+totals_p = daily_by_day.reindex([pday], fill_value=0).iloc[0]
+
+y_clicks = int(totals_y["clicks"])
+p_clicks = int(totals_p["clicks"])
 
-y_leads = int(df_y["leads"].sum())
-p_leads = int(df_p["leads"].sum())
+y_leads = int(totals_y["leads"])
+p_leads = int(totals_p["leads"])
 
-y_sales = int(df_y["sales"].sum())
-p_sales = int(df_p["sales"].sum())
+y_sales = int(totals_y["sales"])
+p_sales = int(totals_p["sales"])
 
 # KPI
 k1, k2, k3 = st.columns(3)
@@ -559,96 +1008,125 @@ with k3:
 
 # График продаж по дням (оставляем)
 st.subheader("📈 Продажи по дням")
-st.line_chart(df.groupby("day")["sales"].sum())
+st.line_chart(daily_by_day["sales"])
 
 # ===================== Top tables =====================
+def top_sales_table(label: str, s_y: pd.Series, s_p: pd.Series) -> pd.DataFrame:
+    """Топ по продажам вчера + Δ% к позавчера одной операцией над Series (prev=0 -> NaN)."""
+    prev = s_p.reindex(s_y.index, fill_value=0).to_numpy(dtype=float)
+    curr = s_y.to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.where(prev != 0, (curr - prev) / prev * 100.0, np.nan)
+    return pd.DataFrame(
+        {label: s_y.index, "Sales (yday)": s_y.to_numpy(dtype=np.int64), "Δ% vs prev": delta}
+    )
+
+
 # Top 5 Sub ID 2 by Sales (exclude Organic)
 st.subheader("🏆 Топ 5 Sub ID 2 по продажам (вчера)")
 
-df_y_non_org = df_y[df_y["sub2_norm"] != "Organic"].copy()
-df_p_non_org = df_p[df_p["sub2_norm"] != "Organic"].copy()
-
-top_sub2_y = df_y_non_org.groupby("sub2_norm")["sales"].sum().sort_values(ascending=False).head(5)
-top_sub2_p = df_p_non_org.groupby("sub2_norm")["sales"].sum()
+df_y_non_org = df_y[df_y["sub2_norm"] != "Organic"]
+df_p_non_org = df_p[df_p["sub2_norm"] != "Organic"]
 
-rows = []
-for sub2, s_y in top_sub2_y.items():
-    s_p = float(top_sub2_p.get(sub2, 0))
-    ch = pct_change(float(s_y), float(s_p))
-    rows.append({"Sub ID 2": sub2, "Sales (yday)": int(s_y), "Δ% vs prev": ch})
+top_sub2_y = df_y_non_org.groupby("sub2_norm", observed=True)["sales"].sum().sort_values(ascending=False).head(5)
+top_sub2_p = df_p_non_org.groupby("sub2_norm", observed=True)["sales"].sum()
 
-df_tbl = pd.DataFrame(rows)
+df_tbl = top_sales_table("Sub ID 2", top_sub2_y, top_sub2_p)
 sty = (
     df_tbl.style
     .format({"Δ% vs prev": fmt_pct_cell})
-    .applymap(style_pct_color, subset=["Δ% vs prev"])
+    .apply(style_pct_color, subset=["Δ% vs prev"])
 )
 st.dataframe(sty, use_container_width=True)
 
 # Top 5 Campaign by Sales (campaign_short)
 st.subheader("🏆 Топ 5 Кампания по продажам (вчера)")
 
-top_c_y = df_y.groupby("campaign_short")["sales"].sum().sort_values(ascending=False).head(5)
-top_c_p = df_p.groupby("campaign_short")["sales"].sum()
+top_c_y = df_y.groupby("campaign_short", observed=True)["sales"].sum().sort_values(ascending=False).head(5)
+top_c_p = df_p.groupby("campaign_short", observed=True)["sales"].sum()
 
-rows = []
-for camp, s_y in top_c_y.items():
-    s_p = float(top_c_p.get(camp, 0))
-    ch = pct_change(float(s_y), float(s_p))
-    rows.append({"Campaign": camp, "Sales (yday)": int(s_y), "Δ% vs prev": ch})
-
-df_tbl = pd.DataFrame(rows)
+df_tbl = top_sales_table("Campaign", top_c_y, top_c_p)
 sty = (
     df_tbl.style
     .format({"Δ% vs prev": fmt_pct_cell})
-    .applymap(style_pct_color, subset=["Δ% vs prev"])
+    .apply(style_pct_color, subset=["Δ% vs prev"])
 )
 st.dataframe(sty, use_container_width=True)
 
 
 # ===================== Gainers (% + NEW) =====================
+# (group_col, exclude_organic) -> пивот по всем метрикам, общий для всех таблиц ниже
+DAY_PIVOTS = {}
+
+
+def two_day_pivot(group_col: str, exclude_organic: bool = False) -> pd.DataFrame:
+    """
+    Один groupby по (group_col, day) сразу для clicks/leads/sales, на rerun считается
+    один раз на group_col — gain_table_pct/new_table берут из него нужную метрику.
+    """
+    key = (group_col, exclude_organic)
+    if key not in DAY_PIVOTS:
+        src = df
+        if exclude_organic and group_col == "sub2_norm":
+            src = src[src["sub2_norm"] != "Organic"]
+        DAY_PIVOTS[key] = (
+            src.groupby([group_col, "day"], observed=True)[["clicks", "leads", "sales"]].sum()
+            .unstack("day", fill_value=0)
+        )
+    return DAY_PIVOTS[key]
+
+
+def two_day_matrix(group_col: str, metric_col: str, exclude_organic: bool = False):
+    """Ключи групп + плотная матрица K × [вчера, позавчера] для одной метрики."""
+    pivot = two_day_pivot(group_col, exclude_organic)
+    if pivot.empty:
+        return pivot.index.values, np.zeros((0, 2), dtype=np.int64)
+
+    m = pivot[metric_col].reindex(columns=[yday, pday], fill_value=0)
+    return m.index, m.to_numpy(dtype=np.int64)
+
+
+def top_n_order(primary: np.ndarray, secondary: np.ndarray, top_n: int) -> np.ndarray:
+    """
+    Позиции top_n по (primary, secondary) desc. argpartition отсекает кандидатов,
+    полная сортировка — только среди них (плюс равные на границе).
+    """
+    if len(primary) > top_n:
+        kth = np.partition(primary, len(primary) - top_n)[len(primary) - top_n]
+        cand = np.flatnonzero(primary >= kth)
+    else:
+        cand = np.arange(len(primary))
+    order = np.lexsort((-secondary[cand], -primary[cand]))
+    return cand[order][:top_n]
+
+
 def gain_table_pct(group_col: str, metric_col: str, title: str, top_n: int = 10, exclude_organic: bool = False):
     st.subheader(title)
 
-    a = df_y.copy()
-    b = df_p.copy()
+    keys, m = two_day_matrix(group_col, metric_col, exclude_organic)
+    y, p = m[:, 0], m[:, 1]
 
-    if exclude_organic and group_col == "sub2_norm":
-        a = a[a["sub2_norm"] != "Organic"]
-        b = b[b["sub2_norm"] != "Organic"]
+    # только рост: prev > 0 и yday > prev
+    grow = np.flatnonzero((p > 0) & (y > p))
+    delta = (y[grow] - p[grow]) / p[grow] * 100.0
 
-    y = a.groupby(group_col)[metric_col].sum()
-    p = b.groupby(group_col)[metric_col].sum()
+    # скоринг: % * объём, чтобы не вылетали “+500% от 1”
+    top = top_n_order(delta * y[grow], y[grow], top_n)
+    sel = grow[top]
 
-    idx = y.index.union(p.index)
     out = pd.DataFrame(
         {
-            group_col: idx,
-            f"{metric_col} (yday)": y.reindex(idx, fill_value=0).astype(int).values,
-            f"{metric_col} (prev)": p.reindex(idx, fill_value=0).astype(int).values,
+            group_col: keys[sel],
+            f"{metric_col} (yday)": y[sel],
+            f"{metric_col} (prev)": p[sel],
+            "Δ% vs prev": delta[top],
         }
     )
 
-    prev_vals = out[f"{metric_col} (prev)"].astype(float)
-    yday_vals = out[f"{metric_col} (yday)"].astype(float)
-
-    out["Δ% vs prev"] = None
-    mask = prev_vals > 0
-    out.loc[mask, "Δ% vs prev"] = ((yday_vals[mask] - prev_vals[mask]) / prev_vals[mask]) * 100.0
-
-    # только рост
-    out = out[out["Δ% vs prev"].notna()]
-    out = out[out["Δ% vs prev"] > 0]
-
-    # скоринг: % * объём, чтобы не вылетали “+500% от 1”
-    out["_score"] = out["Δ% vs prev"].astype(float) * out[f"{metric_col} (yday)"].astype(float)
-    out = out.sort_values(["_score", f"{metric_col} (yday)"], ascending=False).head(top_n)
-    out = out.drop(columns=["_score"])
-
     sty = (
         out.style
         .format({"Δ% vs prev": fmt_pct_cell})
-        .applymap(style_pct_color, subset=["Δ% vs prev"])
+        .apply(style_pct_color, subset=["Δ% vs prev"])
     )
     st.dataframe(sty, use_container_width=True)
 
@@ -656,28 +1134,20 @@ def gain_table_pct(group_col: str, metric_col: str, title: str, top_n: int = 10,
 def new_table(group_col: str, metric_col: str, title: str, top_n: int = 10, exclude_organic: bool = False):
     st.subheader(title)
 
-    a = df_y.copy()
-    b = df_p.copy()
+    keys, m = two_day_matrix(group_col, metric_col, exclude_organic)
+    y, p = m[:, 0], m[:, 1]
 
-    if exclude_organic and group_col == "sub2_norm":
-        a = a[a["sub2_norm"] != "Organic"]
-        b = b[b["sub2_norm"] != "Organic"]
+    new = np.flatnonzero((y > 0) & (p == 0))
+    sel = new[top_n_order(y[new], y[new], top_n)]
 
-    y = a.groupby(group_col)[metric_col].sum()
-    p = b.groupby(group_col)[metric_col].sum()
-
-    idx = y.index.union(p.index)
     out = pd.DataFrame(
         {
-            group_col: idx,
-            f"{metric_col} (yday)": y.reindex(idx, fill_value=0).astype(int).values,
-            f"{metric_col} (prev)": p.reindex(idx, fill_value=0).astype(int).values,
+            group_col: keys[sel],
+            f"{metric_col} (yday)": y[sel],
+            f"{metric_col} (prev)": p[sel],
         }
     )
 
-    out = out[(out[f"{metric_col} (yday)"] > 0) & (out[f"{metric_col} (prev)"] == 0)]
-    out = out.sort_values(f"{metric_col} (yday)", ascending=False).head(top_n)
-
     st.dataframe(out, use_container_width=True)
 
 